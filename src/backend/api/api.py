@@ -1,18 +1,24 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Response
+from fastapi import FastAPI, HTTPException, File, UploadFile, Request, Response
 from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List, AsyncIterator, Tuple
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+import io
 import os
+import re
+import stat
 import sys
-import tempfile
-import uuid
-import shutil
 import logging
-import json
+import orjson
 import asyncio
+import hashlib
+import PIL
+from PIL import features
 from urllib.parse import unquote
+from transformers import TextIteratorStreamer
 
 # Configure logger
 logger = logging.getLogger(__name__)
@@ -21,8 +27,8 @@ logger = logging.getLogger(__name__)
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'functions'))
 
 try:
-    from image_processor import ImageProcessor
-    from folders import get_list_images, inference_on_images
+    from image_processor import ImageProcessor, get_image_processor
+    from folders import get_list_images, inference_on_images, inference_on_images_batch, is_inference_error
 except ImportError as e:
     print(f"Import error: {e}")
     raise
@@ -36,21 +42,191 @@ def ensure_image_processor_initialized():
     if image_processor is None:
         print("Initializing image processor...")
         try:
-            image_processor = ImageProcessor()
+            image_processor = get_image_processor()
             print("Image processor initialized successfully")
         except Exception as e:
             print(f"Failed to initialize image processor: {e}")
             raise
 
+# Maximum number of images handed to the model in one worker step
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+
+# How long the worker waits for more requests to fuse into a batch that is not yet full
+BATCH_WAIT_TIME = float(os.getenv("BATCH_WAIT_TIME", "0.05"))
+
+# Requests waiting for the worker; once full, new requests wait to be queued instead of piling up
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", str(2 * MAX_BATCH_SIZE)))
+
+# Upper bound on model calls in flight at once (batches and token streams alike)
+MAX_CONCURRENT_INFER = int(os.getenv("MAX_CONCURRENT_INFER", "1"))
+
+# Threads that own the model so inference never runs on the event loop
+inference_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_INFER, thread_name_prefix="inference")
+
+def run_inference(image_sources: List) -> List[str]:
+    """Run inference on a list of images (executed on the inference thread)"""
+    model, processor = image_processor._ensure_models_loaded()
+    if len(image_sources) == 1:
+        return [inference_on_images(image_sources[0], image_processor.tokenizer, model)]
+    return inference_on_images_batch(image_sources, image_processor.tokenizer, model, batch_size=MAX_BATCH_SIZE)
+
+async def collect_batch(queue: asyncio.Queue) -> List[Tuple[List, asyncio.Future]]:
+    """Wait for a request, then keep collecting for up to BATCH_WAIT_TIME or until the batch is full"""
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    batch_size = len(batch[0][0])
+    deadline = loop.time() + BATCH_WAIT_TIME
+    while batch_size < MAX_BATCH_SIZE:
+        if queue.empty():
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        else:
+            batch.append(queue.get_nowait())
+        batch_size += len(batch[-1][0])
+    return batch
+
+async def run_batch(batch: List[Tuple[List, asyncio.Future]], semaphore: asyncio.Semaphore):
+    """Run one coalesced batch on the inference thread and resolve each request's future"""
+    try:
+        image_sources = [source for sources, _ in batch for source in sources]
+        try:
+            responses = await asyncio.get_running_loop().run_in_executor(inference_executor, run_inference, image_sources)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        offset = 0
+        for sources, future in batch:
+            if not future.done():
+                future.set_result(responses[offset:offset + len(sources)])
+            offset += len(sources)
+    finally:
+        semaphore.release()
+
+async def inference_worker(queue: asyncio.Queue, semaphore: asyncio.Semaphore):
+    """Single consumer that fuses queued requests into micro-batches
+
+    Batches are dispatched under the inference semaphore, so at most
+    MAX_CONCURRENT_INFER model calls are ever in flight.
+    """
+    pending = set()
+    try:
+        while True:
+            batch = await collect_batch(queue)
+            await semaphore.acquire()
+            task = asyncio.create_task(run_batch(batch, semaphore))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    finally:
+        for task in pending:
+            task.cancel()
+
+def start_inference_worker(app: FastAPI):
+    """Create the request queue, semaphore and consumer task on the running event loop"""
+    app.state.model_queue = asyncio.Queue(maxsize=MAX_QUEUED_REQUESTS)
+    app.state.inference_semaphore = asyncio.Semaphore(MAX_CONCURRENT_INFER)
+    app.state.model_worker = asyncio.create_task(inference_worker(app.state.model_queue, app.state.inference_semaphore))
+    app.state.model_worker_loop = asyncio.get_running_loop()
+
+def ensure_inference_worker(app: FastAPI):
+    """Start the worker if it is missing or bound to a different event loop"""
+    if getattr(app.state, "model_worker_loop", None) is not asyncio.get_running_loop():
+        start_inference_worker(app)
+
+def result_cache_key(image_source) -> Optional[str]:
+    """Key an image for the result cache: content hash for uploads, path + mtime + size for files"""
+    if isinstance(image_source, io.BytesIO):
+        return "blake2b:" + hashlib.blake2b(image_source.getbuffer(), digest_size=16).hexdigest()
+    if isinstance(image_source, str):
+        stat_result = os.stat(image_source)
+        return f"file:{os.path.realpath(image_source)}:{stat_result.st_mtime_ns}:{stat_result.st_size}"
+    return None
+
+async def submit_inference(app: FastAPI, image_sources: List, use_cache: bool = True) -> List[str]:
+    """Queue images for the inference worker and wait for their descriptions
+
+    Images already described (same upload bytes or unchanged file) are served
+    from the result cache without touching the model.
+    """
+    keys = []
+    for source in image_sources:
+        try:
+            keys.append(result_cache_key(source) if use_cache else None)
+        except OSError:
+            keys.append(None)
+    responses = [image_processor.result_cache.get(key) if key else None for key in keys]
+    misses = [i for i, response in enumerate(responses) if response is None]
+    if not misses:
+        return responses
+    
+    ensure_inference_worker(app)
+    future = asyncio.get_running_loop().create_future()
+    await app.state.model_queue.put(([image_sources[i] for i in misses], future))
+    
+    for i, response in zip(misses, await future):
+        responses[i] = response
+        if keys[i] and not is_inference_error(response):
+            image_processor.result_cache.put(keys[i], response)
+    return responses
+
+async def stream_inference(app: FastAPI, image_source) -> Tuple[AsyncIterator[str], asyncio.Future]:
+    """Run inference on the inference thread, streaming text chunks as they are generated
+
+    Returns an async iterator over the generated text and a future resolving
+    to the complete description once generation finishes. The call holds an
+    inference semaphore slot for as long as generation runs.
+    """
+    model, processor = image_processor._ensure_models_loaded()
+    tokenizer = image_processor.tokenizer
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    
+    def generate() -> str:
+        try:
+            return inference_on_images(image_source, tokenizer, model, streamer=streamer)
+        finally:
+            # Unblock the consumer even if generation failed before streaming anything
+            streamer.end()
+    
+    ensure_inference_worker(app)
+    semaphore = app.state.inference_semaphore
+    await semaphore.acquire()
+    try:
+        result = asyncio.get_running_loop().run_in_executor(inference_executor, generate)
+    except BaseException:
+        semaphore.release()
+        raise
+    result.add_done_callback(lambda _: semaphore.release())
+    
+    async def chunks() -> AsyncIterator[str]:
+        iterator = iter(streamer)
+        while (chunk := await asyncio.to_thread(next, iterator, None)) is not None:
+            if chunk:
+                yield chunk
+    
+    return chunks(), result
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application lifespan - startup and shutdown"""
     # Startup
+    # Pillow-SIMD reports versions like "9.5.0.post1"; handy to confirm which build decodes images
+    print(f"Using Pillow {PIL.__version__} (libjpeg-turbo: {features.check_feature('libjpeg_turbo')})")
     ensure_image_processor_initialized()
+    # Warm up on the inference thread, which is the one that later replays compiled graphs
+    await asyncio.get_running_loop().run_in_executor(inference_executor, image_processor.warmup)
+    start_inference_worker(app)
     
     yield
     
     # Shutdown
+    app.state.model_worker.cancel()
     if image_processor:
         print("Cleaning up resources...")
         image_processor.clear_cache()
@@ -62,46 +238,31 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# Add CORS middleware with secure configuration
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[
+# Origins allowed to call the API, comma-separated; set CORS_ALLOW_ORIGINS="*" to allow any during development
+CORS_ALLOW_ORIGINS = os.getenv(
+    "CORS_ALLOW_ORIGINS",
+    ",".join([
         "http://localhost:3000",  # Frontend development server
         "http://127.0.0.1:3000",  # Frontend development server (alternative)
         "http://localhost:5173",  # Vite development server
         "http://127.0.0.1:5173",  # Vite development server (alternative)
         "http://127.0.0.1:8000",  # Backend itself for internal requests
-    ],
+    ])
+).split(",")
+
+# A single CORS middleware covers every route, EventSource streams included
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=CORS_ALLOW_ORIGINS,
     allow_credentials=False,  # Disable credentials for security
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],  # All necessary methods
-    allow_headers=["Content-Type", "Authorization", "Accept", "Accept-Language"],  # Common headers
+    allow_headers=["Content-Type", "Authorization", "Accept", "Accept-Language", "Cache-Control"],  # Common headers
+    expose_headers=["Content-Type"],
 )
 
-# Special middleware for EventSource/Streaming requests
-@app.middleware("http")
-async def add_streaming_cors_headers(request, call_next):
-    response = await call_next(request)
-    # Add CORS headers specifically for streaming endpoints
-    if request.url.path.endswith("/stream"):
-        response.headers["Access-Control-Allow-Origin"] = "*"
-        response.headers["Access-Control-Allow-Methods"] = "GET, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "Content-Type, Cache-Control"
-        response.headers["Access-Control-Expose-Headers"] = "Content-Type"
-        response.headers["Access-Control-Allow-Credentials"] = "false"
-    return response
-
-# Additional middleware to ensure CORS headers are present on all responses
-@app.middleware("http")
-async def add_global_cors_headers(request, call_next):
-    response = await call_next(request)
-    # Add basic CORS headers to all responses for development
-    if "Access-Control-Allow-Origin" not in response.headers:
-        response.headers["Access-Control-Allow-Origin"] = "*"
-    if "Access-Control-Allow-Methods" not in response.headers:
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-    if "Access-Control-Allow-Headers" not in response.headers:
-        response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-    return response
+# Compress JSON responses (folder results grow linearly with max_images);
+# event streams are excluded by Starlette so they keep flushing per event
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 class FolderRequest(BaseModel):
     folder_path: str
@@ -131,64 +292,36 @@ async def process_single_image(file: UploadFile = File(...)):
         logger.error(f"Invalid content type: {file.content_type} for file {file.filename}")
         raise HTTPException(status_code=400, detail=f"File must be an image (received: {file.content_type})")
     
-    # Create temporary file
-    temp_dir = None
-    temp_file_path = None
-    
     try:
-        # Create temporary directory
-        temp_dir = tempfile.mkdtemp()
-        
-        # Generate unique filename
-        file_extension = os.path.splitext(file.filename)[1] if file.filename else '.jpg'
-        temp_filename = f"{uuid.uuid4()}{file_extension}"
-        temp_file_path = os.path.join(temp_dir, temp_filename)
-        
         logger.info(f"Processing uploaded file: {file.filename} (size: {file.size if hasattr(file, 'size') else 'unknown'} bytes)")
-        logger.info(f"Temporary file path: {temp_file_path}")
         
-        # Save uploaded file
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Read the upload once and decode it in memory on the inference worker
+        data = await file.read()
         
-        logger.info("File saved successfully, starting inference...")
+        logger.info("File read successfully, starting inference...")
         
-        # Process the image
-        model, processor = image_processor._ensure_models_loaded()
-        response = inference_on_images(temp_file_path, image_processor.tokenizer, model)
+        # Process the image on the inference worker
+        response = (await submit_inference(app, [io.BytesIO(data)]))[0]
         
         logger.info(f"Inference completed for {file.filename}")
         
-        # Cleanup
-        try:
-            os.remove(temp_file_path)
-            os.rmdir(temp_dir)
-            logger.debug(f"Cleaned up temporary files: {temp_file_path}")
-        except Exception as cleanup_error:
-            logger.warning(f"Failed to cleanup temporary files: {cleanup_error}")
-        
-        return {
-            "filename": file.filename,
-            "status": "success",
-            "description": response
-        }
-        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
     
-    finally:
-        # Clean up temporary files
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-            except Exception:
-                pass
-        
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-            except Exception:
-                pass
+    # Inference reports failures as an error message rather than raising
+    if is_inference_error(response):
+        logger.error(f"Inference failed for {file.filename}: {response}")
+        raise HTTPException(status_code=500, detail=response)
+    
+    return {
+        "filename": file.filename,
+        "status": "success",
+        "description": response
+    }
+
+def sse_event(payload: dict) -> bytes:
+    """Frame one server-sent event; orjson serialises straight to bytes"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
 
 @app.post("/process/image/stream")
 async def process_single_image_stream(file: UploadFile = File(...)):
@@ -203,75 +336,54 @@ async def process_single_image_stream(file: UploadFile = File(...)):
         logger.error(f"Invalid content type: {file.content_type} for file {file.filename}")
         raise HTTPException(status_code=400, detail=f"File must be an image (received: {file.content_type})")
     
-    # Create temporary file
-    temp_dir = None
-    temp_file_path = None
-    
     async def generate_stream():
-        nonlocal temp_dir, temp_file_path
-        
         try:
-            # Create temporary directory
-            temp_dir = tempfile.mkdtemp()
-            
-            # Generate unique filename
-            file_extension = os.path.splitext(file.filename)[1] if file.filename else '.jpg'
-            temp_filename = f"{uuid.uuid4()}{file_extension}"
-            temp_file_path = os.path.join(temp_dir, temp_filename)
-            
             logger.info(f"Processing uploaded file for streaming: {file.filename}")
-            logger.info(f"Temporary file path: {temp_file_path}")
-            
-            # Save uploaded file
-            with open(temp_file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
             
-            logger.info("File saved successfully, starting streaming inference...")
+            # Decode straight from the uploaded bytes; nothing is written to disk
+            data = await file.read()
             
             # Send start event with SSE format
-            yield f"data: {json.dumps({'type': 'start', 'filename': file.filename, 'message': 'Starting image processing...'})}\n\n"
+            yield sse_event({'type': 'start', 'filename': file.filename, 'message': 'Starting image processing...'})
             await asyncio.sleep(0)
             
-            # Process the image
-            model, processor = image_processor._ensure_models_loaded()
-            
             # Send processing event
-            yield f"data: {json.dumps({'type': 'processing', 'filename': file.filename, 'message': 'Running inference on image...'})}\n\n"
+            yield sse_event({'type': 'processing', 'filename': file.filename, 'message': 'Running inference on image...'})
             await asyncio.sleep(0)
             
-            response = inference_on_images(temp_file_path, image_processor.tokenizer, model)
+            # Stream generated text as it is produced
+            tokens, result = await stream_inference(app, io.BytesIO(data))
+            async for token in tokens:
+                yield sse_event({'type': 'token', 'filename': file.filename, 'text': token})
+            response = await result
+            
+            # Inference reports failures as an error message, possibly after partial tokens
+            if is_inference_error(response):
+                logger.error(f"Inference failed for {file.filename}: {response}")
+                yield sse_event({'type': 'error', 'filename': file.filename, 'error': response})
+                return
             
             logger.info(f"Inference completed for {file.filename}")
             
             # Send result event
-            yield f"data: {json.dumps({'type': 'result', 'filename': file.filename, 'status': 'success', 'description': response})}\n\n"
+            yield sse_event({'type': 'result', 'filename': file.filename, 'status': 'success', 'description': response})
             await asyncio.sleep(0)
             
             # Send complete event
-            yield f"data: {json.dumps({'type': 'complete', 'filename': file.filename, 'message': 'Image processing completed successfully'})}\n\n"
+            yield sse_event({'type': 'complete', 'filename': file.filename, 'message': 'Image processing completed successfully'})
             
         except Exception as e:
             logger.error(f"Error processing image in stream: {str(e)}")
-            yield f"data: {json.dumps({'type': 'error', 'filename': file.filename, 'error': str(e)})}\n\n"
-        
-        finally:
-            # Clean up temporary files
-            if temp_file_path and os.path.exists(temp_file_path):
-                try:
-                    os.remove(temp_file_path)
-                    logger.debug(f"Cleaned up temporary file: {temp_file_path}")
-                except Exception as cleanup_error:
-                    logger.warning(f"Failed to cleanup temporary file: {cleanup_error}")
-            
-            if temp_dir and os.path.exists(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir)
-                    logger.debug(f"Cleaned up temporary directory: {temp_dir}")
-                except Exception as cleanup_error:
-                    logger.warning(f"Failed to cleanup temporary directory: {cleanup_error}")
+            yield sse_event({'type': 'error', 'filename': file.filename, 'error': str(e)})
     
     return StreamingResponse(generate_stream(), media_type="text/event-stream")
 
+def folder_image_result(image_path: str, response: str) -> dict:
+    """Build the per-image entry of a folder result"""
+    if is_inference_error(response):
+        return {"image_path": image_path, "status": "error", "error": response}
+    return {"image_path": image_path, "status": "success", "description": response}
+
 @app.post("/process/folder")
 async def process_folder(request: FolderRequest):
     """Process images from a folder using the existing image processor methods"""
@@ -285,7 +397,7 @@ async def process_folder(request: FolderRequest):
     
     try:
         # Get list of images from folder
-        image_paths = get_list_images(request.folder_path, request.extension)
+        image_paths = await asyncio.to_thread(get_list_images, request.folder_path, request.extension)
         
         if not image_paths:
             return {
@@ -294,29 +406,17 @@ async def process_folder(request: FolderRequest):
                 "results": []
             }
         
-        # Get model and processor
-        model, processor = image_processor._ensure_models_loaded()
-        
-        # Process limited number of images
+        # Process limited number of images on the inference worker
         images_to_process = image_paths[:request.max_images]
         results = []
         successful = 0
         
-        for i, image_path in enumerate(images_to_process):
-            try:
-                response = inference_on_images(image_path, image_processor.tokenizer, model)
-                results.append({
-                    "image_path": image_path,
-                    "status": "success", 
-                    "description": response
-                })
+        responses = await submit_inference(app, images_to_process)
+        
+        for image_path, response in zip(images_to_process, responses):
+            results.append(folder_image_result(image_path, response))
+            if results[-1]["status"] == "success":
                 successful += 1
-            except Exception as e:
-                results.append({
-                    "image_path": image_path,
-                    "status": "error",
-                    "error": str(e)
-                })
         
         return {
             "folder_path": request.folder_path,
@@ -335,8 +435,7 @@ async def process_folder(request: FolderRequest):
 async def process_folder_stream(
     folder_path: str,
     extension: str = "jpg",
-    max_images: int = 7,
-    response: Response = None  # Add response parameter for header manipulation
+    max_images: int = 7
 ):
     """Process images from a folder with streaming response"""
     ensure_image_processor_initialized()
@@ -347,61 +446,54 @@ async def process_folder_stream(
     if not os.path.isdir(folder_path):
         raise HTTPException(status_code=400, detail=f"Path is not a directory: {folder_path}")
     
-    # Set CORS headers specifically for streaming endpoints
-    if response:
-        response.headers["Access-Control-Allow-Origin"] = "*"
-        response.headers["Access-Control-Allow-Methods"] = "GET, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "Content-Type"
-        response.headers["Access-Control-Allow-Credentials"] = "false"
-    
     async def generate_stream():
         try:
             # Get list of images from folder
-            image_paths = get_list_images(folder_path, extension)
+            image_paths = await asyncio.to_thread(get_list_images, folder_path, extension)
             
             if not image_paths:
-                yield f"data: {json.dumps({'type': 'complete', 'message': f'No {extension} images found in folder', 'total_found': 0, 'results': []})}\n\n"
+                yield sse_event({'type': 'complete', 'message': f'No {extension} images found in folder', 'total_found': 0, 'results': []})
                 return
             
             # Send initial metadata
-            yield f"data: {json.dumps({'type': 'metadata', 'folder_path': folder_path, 'extension': extension, 'total_found': len(image_paths), 'processed': 0, 'successful': 0, 'failed': 0})}\n\n"
+            yield sse_event({'type': 'metadata', 'folder_path': folder_path, 'extension': extension, 'total_found': len(image_paths), 'processed': 0, 'successful': 0, 'failed': 0})
             
             # Ensure we flush the buffer
             await asyncio.sleep(0)
             
-            # Get model and processor
-            model, processor = image_processor._ensure_models_loaded()
-            
             # Process limited number of images
             images_to_process = image_paths[:max_images]
             successful = 0
             
-            for i, image_path in enumerate(images_to_process):
+            # Process images in batches, announcing each batch before it runs
+            for batch_start in range(0, len(images_to_process), MAX_BATCH_SIZE):
+                batch = images_to_process[batch_start:batch_start + MAX_BATCH_SIZE]
+                
+                # Send start event for each image of this batch
+                for offset, image_path in enumerate(batch):
+                    yield sse_event({'type': 'start', 'image_path': image_path, 'index': batch_start + offset + 1, 'total': len(images_to_process)})
+                await asyncio.sleep(0)
+                
                 try:
-                    # Send start event for this image
-                    yield f"data: {json.dumps({'type': 'start', 'image_path': image_path, 'index': i + 1, 'total': len(images_to_process)})}\n\n"
-                    await asyncio.sleep(0)
-                    
-                    # Process the image and stream the response
-                    response = inference_on_images(image_path, image_processor.tokenizer, model)
-                    
-                    # Send the result
-                    yield f"data: {json.dumps({'type': 'result', 'image_path': image_path, 'status': 'success', 'description': response})}\n\n"
-                    await asyncio.sleep(0)
-                    
-                    successful += 1
-                    
+                    responses = await submit_inference(app, batch)
                 except Exception as e:
-                    logger.error(f"Error processing image {image_path}: {str(e)}")
-                    yield f"data: {json.dumps({'type': 'result', 'image_path': image_path, 'status': 'error', 'error': str(e)})}\n\n"
-                    await asyncio.sleep(0)
+                    logger.error(f"Error processing batch starting at {batch[0]}: {str(e)}")
+                    responses = [f"Error processing image: {str(e)}"] * len(batch)
+                
+                # Send the result for each image
+                for image_path, response in zip(batch, responses):
+                    result = folder_image_result(image_path, response)
+                    yield sse_event({'type': 'result', **result})
+                    if result["status"] == "success":
+                        successful += 1
+                await asyncio.sleep(0)
             
             # Send final summary
-            yield f"data: {json.dumps({'type': 'complete', 'processed': len(images_to_process), 'successful': successful, 'failed': len(images_to_process) - successful})}\n\n"
+            yield sse_event({'type': 'complete', 'processed': len(images_to_process), 'successful': successful, 'failed': len(images_to_process) - successful})
             
         except Exception as e:
             logger.error(f"Error in folder streaming: {str(e)}")
-            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+            yield sse_event({'type': 'error', 'error': str(e)})
     
     return StreamingResponse(generate_stream(), media_type="text/event-stream")
 
@@ -416,7 +508,7 @@ async def preview_folder_images(request: FolderRequest):
     
     try:
         # Get list of images
-        image_paths = get_list_images(request.folder_path, request.extension)
+        image_paths = await asyncio.to_thread(get_list_images, request.folder_path, request.extension)
         
         return {
             "folder_path": request.folder_path,
@@ -428,29 +520,55 @@ async def preview_folder_images(request: FolderRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error previewing folder: {str(e)}")
 
+# Image extensions that /image is allowed to serve
+ALLOWED_IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', '.heic', '.heif'})
+_PATH_TRAVERSAL_RE = re.compile(r'(?:^|/)\.\.(?:/|$)')
+
 @app.get("/image/{image_path:path}")
-async def serve_image(image_path: str):
+async def serve_image(image_path: str, request: Request):
     """Serve images from the server filesystem for display in the frontend"""
     try:
         # Decode the URL-encoded path
         decoded_path = unquote(image_path)
         
-        # Security check: ensure the path is absolute and exists
+        # Security check: ensure the path is absolute and has no parent-directory segments
         if not os.path.isabs(decoded_path):
             raise HTTPException(status_code=400, detail="Only absolute paths are allowed")
         
-        if not os.path.exists(decoded_path):
+        if _PATH_TRAVERSAL_RE.search(decoded_path):
+            raise HTTPException(status_code=400, detail="Path traversal is not allowed")
+        
+        # A single stat covers both the existence and the regular-file checks; like
+        # os.path.exists, any path that can't be stat'ed counts as missing
+        try:
+            stat_result = os.stat(decoded_path)
+        except (OSError, ValueError):
             raise HTTPException(status_code=404, detail="Image not found")
         
-        if not os.path.isfile(decoded_path):
+        if not stat.S_ISREG(stat_result.st_mode):
             raise HTTPException(status_code=400, detail="Path is not a file")
         
         # Additional security: check if it's actually an image file
-        allowed_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', '.heic')
-        if not decoded_path.lower().endswith(allowed_extensions):
+        if os.path.splitext(decoded_path)[1].lower() not in ALLOWED_IMAGE_EXTENSIONS:
             raise HTTPException(status_code=400, detail="File is not an image")
         
-        return FileResponse(decoded_path)
+        # Pass the stat result so Starlette skips its own stat; it also derives
+        # ETag/Last-Modified from it, letting browsers revalidate instead of re-fetching
+        response = FileResponse(
+            decoded_path,
+            stat_result=stat_result,
+            headers={"Cache-Control": "public, max-age=86400"}
+        )
+        
+        # Answer revalidations of an unchanged file without reading it
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            etag = response.headers["etag"]
+            if any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")):
+                return Response(status_code=304, headers={
+                    name: response.headers[name] for name in ("etag", "last-modified", "cache-control")
+                })
+        return response
         
     except HTTPException:
         raise
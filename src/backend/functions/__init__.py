@@ -1,11 +1,13 @@
 """Functions module for image processing and utilities"""
 
-from .folders import get_list_images, inference_on_images, path_folder_env
-from .image_processor import ImageProcessor
+from .folders import get_list_images, inference_on_images, inference_on_images_batch, path_folder_env
+from .image_processor import ImageProcessor, get_image_processor
 
 __all__ = [
     "get_list_images",
     "inference_on_images", 
+    "inference_on_images_batch",
     "path_folder_env",
-    "ImageProcessor"
+    "ImageProcessor",
+    "get_image_processor"
 ]
\ No newline at end of file
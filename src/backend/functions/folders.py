@@ -1,32 +1,62 @@
-import glob
+import io
 import os
-from dotenv import load_dotenv, dotenv_values
-from typing import List
+from dotenv import load_dotenv
+from typing import Dict, List, Optional, Sequence, Tuple, Union, BinaryIO
 import torch
-import torchvision.transforms as T
-import math
+from torchvision.transforms import v2 as T2
+import torch.nn.functional as F
+from torchvision.io import ImageReadMode, decode_jpeg
 import numpy as np
 from PIL import Image
 from torchvision.transforms.functional import InterpolationMode
-from transformers.image_utils import load_image
-from transformers import AutoProcessor, AutoModel
-import os
 import logging
+from pillow_heif import register_heif_opener
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import functools
+import contextlib
+import hashlib
+import gc
 load_dotenv()
 
+# Let PIL decode iPhone HEIC/HEIF photos through libheif
+register_heif_opener()
+
 path_folder_env=os.getenv("PATH_TO_FOLDER_TEST")
 
+# InternVL3.5 uses the <image> token to place the image in the prompt
+DEFAULT_QUESTION = "<image>\nDescribe this image briefly."
+# Answer length cap; descriptions are short, and every generated token is a full decode step
+MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "128"))
+# Number of preprocessed files kept in memory so re-scanning a folder skips decoding
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "64"))
+# Longest edge images are shrunk to before preprocessing (0 disables the cap)
+VLM_MAX_EDGE = int(os.getenv("VLM_MAX_EDGE", "1024"))
+# GPU_JPEG_DECODE=1 decodes JPEGs with nvJPEG and tiles them on the GPU (thread preprocess pool only)
+GPU_JPEG_DECODE = os.getenv("GPU_JPEG_DECODE", "0") == "1"
+# VISION_CACHE=1 keeps vision-encoder features on disk, so re-runs over unchanged files only decode text
+VISION_CACHE = os.getenv("VISION_CACHE", "0") == "1"
+VISION_CACHE_DIR = os.getenv("VISION_CACHE_DIR", os.path.expanduser("~/.cache/images-sorter/vision"))
+# Least recently used feature files are deleted beyond this size (0 lets the cache grow without limit)
+VISION_CACHE_MAX_MB = int(os.getenv("VISION_CACHE_MAX_MB", "4096"))
+# Bump when preprocessing changes in a way the settings in the vision cache key don't capture
+VISION_CACHE_VERSION = 1
+
 # InternVL3.5 Image preprocessing constants and functions
 IMAGENET_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_STD = (0.229, 0.224, 0.225)
 
+@functools.lru_cache(maxsize=8)
 def build_transform(input_size):
+    # Expects RGB tiles: open_image converts once before tiling. Resize runs on the PIL tile,
+    # so results match tiles_to_pixel_values; the rest is tensor-native v2 ops
     MEAN, STD = IMAGENET_MEAN, IMAGENET_STD
-    transform = T.Compose([
-        T.Lambda(lambda img: img.convert('RGB') if img.mode != 'RGB' else img),
-        T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
-        T.ToTensor(),
-        T.Normalize(mean=MEAN, std=STD)
+    transform = T2.Compose([
+        T2.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
+        T2.PILToTensor(),
+        T2.ToDtype(torch.float32, scale=True),
+        T2.Normalize(mean=MEAN, std=STD)
     ])
     return transform
 
@@ -45,20 +75,30 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
                 best_ratio = ratio
     return best_ratio
 
-def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False):
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
-
-    # calculate the existing image aspect ratio
+@functools.lru_cache(maxsize=32)
+def _get_target_ratios(min_num: int, max_num: int) -> Tuple[Tuple[int, int], ...]:
+    """Tile grids (columns, rows) with between min_num and max_num tiles, fewest tiles first"""
     target_ratios = set(
         (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
         i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    return tuple(sorted(target_ratios, key=lambda x: x[0] * x[1]))
+
+# Photos from one camera share a handful of sizes, so the grid choice is memoised per size
+@functools.lru_cache(maxsize=256)
+def get_target_aspect_ratio(orig_width, orig_height, min_num=1, max_num=12, image_size=448):
+    aspect_ratio = orig_width / orig_height
+
+    # calculate the existing image aspect ratio
+    target_ratios = _get_target_ratios(min_num, max_num)
 
     # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
+    return find_closest_aspect_ratio(
         aspect_ratio, target_ratios, orig_width, orig_height, image_size)
 
+def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False):
+    orig_width, orig_height = image.size
+    target_aspect_ratio = get_target_aspect_ratio(orig_width, orig_height, min_num, max_num, image_size)
+
     # calculate the target width and height
     target_width = image_size * target_aspect_ratio[0]
     target_height = image_size * target_aspect_ratio[1]
@@ -66,47 +106,183 @@ def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbna
 
     # resize the image
     resized_img = image.resize((target_width, target_height))
-    processed_images = []
-    for i in range(blocks):
-        box = (
-            (i % (target_width // image_size)) * image_size,
-            (i // (target_width // image_size)) * image_size,
-            ((i % (target_width // image_size)) + 1) * image_size,
-            ((i // (target_width // image_size)) + 1) * image_size
-        )
-        # split the image
-        split_img = resized_img.crop(box)
-        processed_images.append(split_img)
+    cols, rows = target_aspect_ratio
+    # split the image into row-major tiles
+    processed_images = [
+        resized_img.crop((c * image_size, r * image_size, (c + 1) * image_size, (r + 1) * image_size))
+        for r in range(rows) for c in range(cols)
+    ]
     assert len(processed_images) == blocks
     if use_thumbnail and len(processed_images) != 1:
         thumbnail_img = image.resize((image_size, image_size))
         processed_images.append(thumbnail_img)
     return processed_images
 
-def load_image_for_internvl(image_file, input_size=448, max_num=6):
+# An image can be given as a file path, an in-memory file object or a decoded PIL image
+ImageSource = Union[str, BinaryIO, Image.Image]
+
+def open_image(source: ImageSource, draft_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """Open an image source and return it as an RGB PIL image
+
+    When draft_size is given, JPEGs are decoded with libjpeg's DCT scaling
+    straight to the smallest scale that still covers draft_size.
+    """
+    if isinstance(source, Image.Image):
+        return source.convert('RGB')
+    image = Image.open(source)
+    if draft_size is not None:
+        image.draft('RGB', draft_size)
+    return image.convert('RGB')
+
+def _resize_max_edge(image: Image.Image, max_edge: int = VLM_MAX_EDGE) -> Image.Image:
+    """Shrink an image with Lanczos so its longest edge is at most max_edge"""
+    width, height = image.size
+    if max_edge <= 0 or max(width, height) <= max_edge:
+        return image
+    scale = max_edge / max(width, height)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    # reducing_gap lets PIL box-reduce by an integer factor first, which is much cheaper on large photos
+    return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+def load_image_for_internvl(image_file: ImageSource, input_size=448, max_num=6):
     """Load and preprocess image for InternVL3.5 model
     
     Note: Reduced max_num to 6 and disabled thumbnail for CPU performance
     """
-    image = Image.open(image_file).convert('RGB')
-    transform = build_transform(input_size=input_size)
-    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=False, max_num=max_num)
-    pixel_values = [transform(image) for image in images]
-    pixel_values = torch.stack(pixel_values)
-    return pixel_values.to(torch.bfloat16)
+    if isinstance(image_file, Image.Image):
+        ratio = get_target_aspect_ratio(*image_file.size, max_num=max_num, image_size=input_size)
+        draft_size = None
+    else:
+        # Only the header is read here; size the decode to the tile canvas the image is resized to
+        with Image.open(image_file) as header:
+            ratio = get_target_aspect_ratio(*header.size, max_num=max_num, image_size=input_size)
+        draft_size = (input_size * ratio[0], input_size * ratio[1])
+        if hasattr(image_file, 'seek'):
+            image_file.seek(0)
+    image = open_image(image_file, draft_size)
+    if VLM_MAX_EDGE > 0:
+        # Never shrink below the tile canvas, or tiling would just scale the image back up
+        image = _resize_max_edge(image, max(VLM_MAX_EDGE, input_size * max(ratio)))
+    return tiles_to_pixel_values(image, input_size=input_size, max_num=max_num)
+
+# Normalisation constants shaped to broadcast over (tiles, channels, height, width)
+_MEAN_TENSOR = torch.tensor(IMAGENET_MEAN).view(3, 1, 1)
+_STD_TENSOR = torch.tensor(IMAGENET_STD).view(3, 1, 1)
+
+def tiles_to_pixel_values(image: Image.Image, input_size=448, max_num=6) -> torch.Tensor:
+    """Tile an RGB image the way dynamic_preprocess does and normalise all tiles in one pass
+
+    The image is resized once to the tile canvas and converted to a single
+    uint8 tensor; tiles are then views of that tensor, so scaling and
+    normalisation run as one batched op instead of once per tile.
+    Equivalent to build_transform over each dynamic_preprocess tile.
+    """
+    cols, rows = get_target_aspect_ratio(*image.size, max_num=max_num, image_size=input_size)
+    canvas = image.resize((input_size * cols, input_size * rows), Image.Resampling.BICUBIC)
+    pixels = torch.from_numpy(np.array(canvas))  # (rows*H, cols*W, 3) uint8
+    # Row-major tile order, matching the crop boxes of dynamic_preprocess. Tiles keep
+    # PIL's interleaved channels, so the NCHW result is channels_last at no extra cost,
+    # the layout cuDNN prefers for the vision encoder's patch-embedding conv
+    tiles = torch.empty((rows * cols, input_size, input_size, 3), dtype=torch.float32)
+    # One strided copy gathers the tiles and converts to float, with no intermediate buffer
+    tiles.view(rows, cols, input_size, input_size, 3).copy_(
+        pixels.view(rows, input_size, cols, input_size, 3).permute(0, 2, 1, 3, 4)
+    )
+    tiles = tiles.permute(0, 3, 1, 2).div_(255).sub_(_MEAN_TENSOR).div_(_STD_TENSOR)
+    return tiles.to(torch.bfloat16)
+
+@functools.lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def _cached_load(path: str, mtime_ns: int, size: int) -> torch.Tensor:
+    """Preprocess a file once per (path, mtime, size), so an edited file gets a fresh entry"""
+    return load_image_for_internvl(path)
+
+def _read_jpeg_bytes(source: ImageSource) -> Optional[torch.Tensor]:
+    """Return the encoded bytes of a JPEG path or in-memory file as a uint8 tensor, None otherwise"""
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            data = bytearray(f.read())
+    elif isinstance(source, io.BytesIO):
+        data = bytearray(source.getbuffer())
+    else:
+        return None
+    if data[:3] != b'\xff\xd8\xff':
+        return None
+    return torch.frombuffer(data, dtype=torch.uint8)
+
+def _tile_on_device(image: torch.Tensor, input_size=448, max_num=6) -> torch.Tensor:
+    """Tile and normalise a decoded (3, H, W) uint8 image on its own device, mirroring tiles_to_pixel_values"""
+    device = image.device
+    height, width = image.shape[1:]
+    cols, rows = get_target_aspect_ratio(width, height, max_num=max_num, image_size=input_size)
+    canvas = F.interpolate(
+        image.unsqueeze(0).float(), size=(rows * input_size, cols * input_size),
+        mode='bicubic', align_corners=False, antialias=True
+    )[0].clamp_(0, 255)
+    tiles = canvas.view(3, rows, input_size, cols, input_size).permute(1, 3, 0, 2, 4)
+    tiles = tiles.reshape(rows * cols, 3, input_size, input_size)
+    tiles = tiles.div_(255).sub_(_MEAN_TENSOR.to(device)).div_(_STD_TENSOR.to(device))
+    return tiles.to(torch.bfloat16).contiguous(memory_format=torch.channels_last)
+
+def load_jpeg_tiles(encoded: torch.Tensor, input_size=448, max_num=6, device='cuda') -> torch.Tensor:
+    """Decode a JPEG on the device and tile/normalise it there, mirroring tiles_to_pixel_values
+
+    With device='cuda' the decode runs on nvJPEG, so neither the decoded image
+    nor the tiles pass through host memory. The canvas resize is torch's
+    antialiased bicubic rather than PIL's, so values differ slightly from
+    the CPU path.
+    """
+    image = decode_jpeg(encoded, mode=ImageReadMode.RGB, device=device)  # (3, H, W) uint8
+    return _tile_on_device(image, input_size, max_num)
+
+def load_jpeg_tiles_batch(encoded: List[torch.Tensor], input_size=448, max_num=6, device='cuda') -> List[torch.Tensor]:
+    """Decode several JPEGs in one batched nvJPEG call, then tile each like load_jpeg_tiles"""
+    images = decode_jpeg(encoded, mode=ImageReadMode.RGB, device=device)
+    return [_tile_on_device(image, input_size, max_num) for image in images]
+
+def _use_gpu_jpeg_decode() -> bool:
+    """GPU decode needs CUDA, and tiles can't leave a worker process, so only the thread pool uses it"""
+    return GPU_JPEG_DECODE and PREPROCESS_POOL == "thread" and torch.cuda.is_available()
 
-def get_list_images(path: str, ext: str) -> List[str]:
+def load_pixel_values(source: ImageSource) -> torch.Tensor:
+    """Preprocess an image source, reusing cached pixel values for unchanged files"""
+    if _use_gpu_jpeg_decode():
+        encoded = _read_jpeg_bytes(source)
+        if encoded is not None:
+            # Not cached: the tiles live in GPU memory
+            return load_jpeg_tiles(encoded)
+    if isinstance(source, str):
+        stat_result = os.stat(source)
+        return _cached_load(os.path.realpath(source), stat_result.st_mtime_ns, stat_result.st_size)
+    return load_image_for_internvl(source)
+
+def get_list_images(path: str, ext: Union[str, Sequence[str]]) -> List[str]:
     """
     This function return list of files into a folder
 
     Args:
         path (str): the path of where to load files
-        ext (str): the extension of the file
+        ext (str | Sequence[str]): the extension of the file, several comma-separated
+            extensions (e.g. "jpg,png") or a sequence of them; matched case-insensitively
     
     Returns:
         List[str]: The list of files from the extension 
     """
-    return glob.glob(f"{path}/*.{ext}")
+    exts = ext.split(',') if isinstance(ext, str) else ext
+    suffixes = tuple('.' + e.strip().lstrip('.').lower() for e in exts if e.strip())
+    try:
+        with os.scandir(path) as entries:
+            # Hidden files are skipped, as glob's "*" did
+            return [
+                entry.path for entry in entries
+                if not entry.name.startswith('.') and entry.name.lower().endswith(suffixes) and entry.is_file()
+            ]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+@functools.lru_cache(maxsize=4)
+def _tokenize_prompt(tokenizer, prompt: str) -> Tuple[Tuple[str, torch.Tensor], ...]:
+    """Tokenize a fixed prompt once per tokenizer; returned as immutable (name, tensor) pairs"""
+    return tuple(tokenizer(prompt, return_tensors='pt').items())
 
 def inference_on_images_alternative(path: str, tokenizer, model) -> str:
     """
@@ -116,7 +292,7 @@ def inference_on_images_alternative(path: str, tokenizer, model) -> str:
         logging.info(f"Starting alternative inference for image: {path}")
         
         # Load and preprocess image
-        pixel_values = load_image_for_internvl(path)
+        pixel_values = load_pixel_values(path)
         
         # Move to device
         if hasattr(model, 'device'):
@@ -129,8 +305,8 @@ def inference_on_images_alternative(path: str, tokenizer, model) -> str:
         prompt = "<image>\nDescribe this image."
         logging.info(f"Using prompt: {prompt}")
         
-        # Tokenize the prompt
-        inputs = tokenizer(prompt, return_tensors='pt')
+        # Tokenize the prompt (cached; copied so the cached entry is never mutated)
+        inputs = dict(_tokenize_prompt(tokenizer, prompt))
         if torch.cuda.is_available():
             inputs = {k: v.cuda() for k, v in inputs.items()}
         
@@ -141,11 +317,10 @@ def inference_on_images_alternative(path: str, tokenizer, model) -> str:
         
         # Use model.generate directly
         try:
-            with torch.no_grad():
+            with _generation_context(model):
                 outputs = model.generate(
                     **inputs,
-                    max_new_tokens=128,  # Reduced for CPU performance
-                    do_sample=False,
+                    **greedy_generation_config(MAX_NEW_TOKENS),
                     pad_token_id=tokenizer.eos_token_id
                 )
             
@@ -167,48 +342,408 @@ def inference_on_images_alternative(path: str, tokenizer, model) -> str:
         return f"Error in alternative inference: {str(e)}"
 
 
-def inference_on_images(path: str, tokenizer, model) -> str:
+def is_inference_error(response: str) -> bool:
+    """Check whether an inference response is an error message rather than a description"""
+    return response.startswith("Error processing image") or response.startswith("Error in alternative")
+
+# Image decoding (PIL/libjpeg) releases the GIL, so folder images are decoded concurrently
+# PREPROCESS_POOL=process moves decoding to worker processes for formats whose decoders hold the GIL
+PREPROCESS_POOL = os.getenv("PREPROCESS_POOL", "thread")
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+def _make_preprocess_executor() -> Executor:
+    """Create the pool that decodes and preprocesses images ahead of the GPU"""
+    if PREPROCESS_POOL == "process":
+        # spawn rather than fork: forking a process that has initialised CUDA is unsafe.
+        # Tensors come back through torch's shared-memory pickling, and each worker keeps
+        # its own preprocessed-image cache.
+        return ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+
+_preprocess_executor = _make_preprocess_executor()
+# Separate thread driving chunk-level prefetch, so it never waits on its own pool
+_prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+
+def _is_vllm_engine(model) -> bool:
+    """Check whether the model is a vLLM engine rather than a Transformers model"""
+    return type(model).__module__.startswith("vllm")
+
+@functools.lru_cache(maxsize=8)
+def _render_chat_prompt(tokenizer, question: str) -> str:
+    """Chat-template prompt string for a question, rendered once per (tokenizer, question)"""
+    return tokenizer.apply_chat_template(
+        [{"role": "user", "content": question}],
+        tokenize=False,
+        add_generation_prompt=True
+    )
+
+def inference_on_images_vllm(paths: List[ImageSource], llm, question: str = DEFAULT_QUESTION,
+                             max_new_tokens: int = MAX_NEW_TOKENS) -> List[str]:
+    """
+    Perform image inference on a list of images with a vLLM engine
+
+    All prompts are submitted in a single generate call so vLLM can schedule
+    them concurrently with continuous batching.
+    """
+    from vllm import SamplingParams
+
+    prompt = _render_chat_prompt(llm.get_tokenizer(), question)
+    sampling_params = SamplingParams(temperature=0, max_tokens=max_new_tokens)
+
+    requests = []
+    for path in paths:
+        image = _resize_max_edge(open_image(path))
+        requests.append({"prompt": prompt, "multi_modal_data": {"image": image}})
+
+    logging.info(f"Submitting {len(requests)} image(s) to vLLM")
+    outputs = llm.generate(requests, sampling_params)
+    return [output.outputs[0].text for output in outputs]
+
+def _decode_jpegs_on_gpu(paths: List[ImageSource]) -> Dict[int, torch.Tensor]:
+    """Tiles for the JPEGs among paths, decoded together in one nvJPEG batch
+
+    Anything left out (other formats, unreadable files, or every image if the
+    batched decode fails) goes through load_pixel_values one at a time, which
+    reports the error for the offending image.
+    """
+    encoded: Dict[int, torch.Tensor] = {}
+    for i, path in enumerate(paths):
+        try:
+            data = _read_jpeg_bytes(path)
+        except OSError:
+            continue
+        if data is not None:
+            encoded[i] = data
+    if not encoded:
+        return {}
+    try:
+        return dict(zip(encoded, load_jpeg_tiles_batch(list(encoded.values()))))
+    except RuntimeError as e:
+        logging.warning(f"Batched GPU JPEG decode failed, decoding images one at a time: {e}")
+        return {}
+
+def preprocess_images(paths: List[ImageSource]) -> List[Union[torch.Tensor, str]]:
+    """
+    Decode and preprocess images in parallel for InternVL3.5
+
+    Returns one entry per image: its pixel values, or an error message if the
+    image couldn't be loaded, so one unreadable file doesn't fail the batch.
+    """
+    prepared: List[Union[torch.Tensor, str]] = []
+    gpu_tiles = _decode_jpegs_on_gpu(paths) if _use_gpu_jpeg_decode() else {}
+    futures = [None if i in gpu_tiles else _preprocess_executor.submit(load_pixel_values, path)
+               for i, path in enumerate(paths)]
+    for i, (path, future) in enumerate(zip(paths, futures)):
+        if future is None:
+            prepared.append(gpu_tiles[i])
+            continue
+        try:
+            prepared.append(future.result())
+        except Exception as e:
+            logging.error(f"Error processing image {path}: {e}")
+            prepared.append(f"Error processing image: {str(e)}")
+    return prepared
+
+def greedy_generation_config(max_new_tokens: int = MAX_NEW_TOKENS) -> dict:
+    """Generation settings shared by every Transformers path
+
+    Greedy single-beam decoding that reuses the KV cache across steps, set
+    explicitly so a checkpoint's generation_config can't silently turn it off.
+    """
+    return dict(max_new_tokens=max_new_tokens, do_sample=False, num_beams=1, use_cache=True)
+
+def _generation_context(model) -> contextlib.ExitStack:
+    """Inference mode for generation, plus bf16 autocast if the weights were loaded in fp32 on CUDA"""
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    device = getattr(model, "device", None)
+    if isinstance(device, torch.device) and device.type == "cuda" and getattr(model, "dtype", None) == torch.float32:
+        stack.enter_context(torch.autocast(device_type="cuda", dtype=torch.bfloat16))
+    return stack
+
+def _vision_cache_file(source: ImageSource, model, input_size=448, max_num=6) -> Optional[str]:
+    """Cache file for a path's vision features; None if not cacheable
+
+    Keyed on the model, the file (path, mtime, size) and every setting that
+    changes its pixel values, so a changed setting never reuses stale features.
+    """
+    if not VISION_CACHE or not isinstance(source, str):
+        return None
+    stat_result = os.stat(source)
+    key = "|".join(str(part) for part in (
+        VISION_CACHE_VERSION, getattr(model, "name_or_path", ""), getattr(model, "dtype", ""),
+        os.path.realpath(source), stat_result.st_mtime_ns, stat_result.st_size,
+        input_size, max_num, VLM_MAX_EDGE, _use_gpu_jpeg_decode(), IMAGENET_MEAN, IMAGENET_STD
+    ))
+    return os.path.join(VISION_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".pt")
+
+def _evict_vision_cache(max_bytes: int) -> None:
+    """Delete the least recently used feature files until VISION_CACHE_DIR fits in max_bytes"""
+    with os.scandir(VISION_CACHE_DIR) as entries:
+        files = [(entry.stat(), entry.path) for entry in entries if entry.name.endswith(".pt")]
+    total = sum(stat_result.st_size for stat_result, _ in files)
+    for stat_result, path in sorted(files, key=lambda item: item[0].st_mtime_ns):
+        if total <= max_bytes:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total -= stat_result.st_size
+
+def _vision_features(sources: List[ImageSource], tiles: List[torch.Tensor], model) -> Optional[torch.Tensor]:
+    """Vision-encoder features of each image's tiles, concatenated in order
+
+    Features of unchanged files are loaded from VISION_CACHE_DIR; the rest run
+    through model.extract_feature in one pass and are saved for the next run.
+    Returns None when nothing is cacheable, leaving extraction to the model.
+    """
+    cache_files = [_vision_cache_file(source, model) for source in sources]
+    if not any(cache_files):
+        return None
+
+    features: List[Optional[torch.Tensor]] = [None] * len(tiles)
+    for i, cache_file in enumerate(cache_files):
+        if cache_file and os.path.exists(cache_file):
+            try:
+                features[i] = torch.load(cache_file, map_location=_model_device(model))
+                # Refresh the mtime, which eviction uses as the last-used time
+                os.utime(cache_file)
+            except Exception as e:
+                logging.warning(f"Ignoring unreadable vision cache entry {cache_file}: {e}")
+
+    misses = [i for i, feature in enumerate(features) if feature is None]
+    if misses:
+        pixel_values = _move_to_model_device(_concat_tiles([tiles[i] for i in misses], model), model)
+        with _generation_context(model):
+            extracted = model.extract_feature(pixel_values)
+        os.makedirs(VISION_CACHE_DIR, exist_ok=True)
+        for i, feature in zip(misses, extracted.split([tiles[i].size(0) for i in misses])):
+            features[i] = feature
+            if cache_files[i]:
+                # clone so only this image's slice is written; rename so readers never see a partial file
+                torch.save(feature.cpu().clone(), cache_files[i] + ".tmp")
+                os.replace(cache_files[i] + ".tmp", cache_files[i])
+        if VISION_CACHE_MAX_MB > 0:
+            _evict_vision_cache(VISION_CACHE_MAX_MB * 2**20)
+    logging.info(f"Vision features: {len(tiles) - len(misses)} cached, {len(misses)} extracted")
+    return torch.cat(features)
+
+def inference_on_preprocessed(prepared: List[Union[torch.Tensor, str]], tokenizer, model,
+                              question: str = DEFAULT_QUESTION, max_new_tokens: int = MAX_NEW_TOKENS,
+                              sources: Optional[List[ImageSource]] = None) -> List[str]:
+    """
+    Run a single batched generate over preprocessed images via model.batch_chat()
+
+    sources are the images prepared came from; paths among them let the
+    vision features be served from the on-disk cache (VISION_CACHE=1).
+    A batch that runs out of GPU memory is split in half and retried.
+    """
+    responses = [entry if isinstance(entry, str) else "" for entry in prepared]
+    batch_indices = [i for i, entry in enumerate(prepared) if not isinstance(entry, str)]
+    if not batch_indices:
+        return responses
+
+    try:
+        # Concatenate all tiles and run a single batched generate via model.batch_chat()
+        batch_pixel_values = [prepared[i] for i in batch_indices]
+        num_patches_list = [pixel_values.size(0) for pixel_values in batch_pixel_values]
+        generation_config = greedy_generation_config(max_new_tokens)
+        features = _vision_features([sources[i] for i in batch_indices], batch_pixel_values, model) if sources else None
+        if features is not None:
+            # generate() uses visual_features in place of running the vision encoder on pixel_values
+            generation_config["visual_features"] = features
+        pixel_values = _move_to_model_device(_concat_tiles(batch_pixel_values, model), model)
+        logging.info(f"Starting model.batch_chat() inference on {len(batch_indices)} images...")
+        with _generation_context(model):
+            batch_responses = model.batch_chat(
+                tokenizer,
+                pixel_values,
+                num_patches_list=num_patches_list,
+                questions=[question] * len(batch_indices),
+                generation_config=generation_config
+            )
+        logging.info("Model batch chat completed successfully")
+    except torch.cuda.OutOfMemoryError as e:
+        if len(batch_indices) == 1:
+            logging.error(f"Out of GPU memory processing image: {e}")
+            batch_responses = [f"Error processing image: {str(e)}"]
+        else:
+            logging.warning(f"Out of GPU memory on a batch of {len(batch_indices)} images, retrying in halves")
+            batch_responses = None
+    except Exception as e:
+        logging.error(f"Error processing batch of {len(batch_indices)} images: {e}")
+        batch_responses = [f"Error processing image: {str(e)}"] * len(batch_indices)
+
+    if batch_responses is None:
+        # Drop the failed batch's device tensors so the retries can reuse their blocks;
+        # the caching allocator hands them out again without a synchronising empty_cache()
+        pixel_values = features = None
+        gc.collect()
+        # Each half is retried as a batch and splits again only if it still doesn't fit
+        half = len(batch_indices) // 2
+        batch_responses = []
+        for part in (batch_indices[:half], batch_indices[half:]):
+            batch_responses.extend(inference_on_preprocessed(
+                [prepared[i] for i in part], tokenizer, model, question, max_new_tokens,
+                [sources[i] for i in part] if sources else None
+            ))
+
+    for i, response in zip(batch_indices, batch_responses):
+        responses[i] = response
+    return responses
+
+def prefetch_iter(items: List, fn, prefetch: int = 1):
+    """
+    Yield fn(item) for each item, computing up to `prefetch` results ahead
+
+    Lets CPU-side preprocessing of the next chunk run while the caller keeps
+    the GPU busy with the current one.
+    """
+    pending = deque()
+    items = iter(items)
+    for item in items:
+        pending.append(_prefetch_executor.submit(fn, item))
+        if len(pending) > prefetch:
+            break
+    while pending:
+        result = pending.popleft().result()
+        next_item = next(items, None)
+        if next_item is not None:
+            pending.append(_prefetch_executor.submit(fn, next_item))
+        yield result
+
+def _tile_count(source: ImageSource, input_size=448, max_num=6) -> int:
+    """Number of tiles a file is split into, from its header alone; 0 for other sources or unreadable files"""
+    if not isinstance(source, str):
+        return 0
+    try:
+        with Image.open(source) as header:
+            cols, rows = get_target_aspect_ratio(*header.size, max_num=max_num, image_size=input_size)
+    except Exception:
+        return 0
+    return cols * rows
+
+def inference_on_images_batch(paths: List[ImageSource], tokenizer, model,
+                              batch_size: Optional[int] = None, question: str = DEFAULT_QUESTION,
+                              max_new_tokens: int = MAX_NEW_TOKENS) -> List[str]:
+    """
+    Perform image inference on a list of images, batched when the backend supports it
+
+    With batch_size, images are generated in chunks of that size and the next
+    chunk is decoded while the current one is on the GPU. Chunks group images
+    of similar tile counts; responses are returned in the order of paths.
+    """
+    if _is_vllm_engine(model):
+        try:
+            return inference_on_images_vllm(paths, model, question, max_new_tokens)
+        except Exception as e:
+            logging.error(f"Error processing batch of {len(paths)} images: {e}")
+            return [f"Error processing image: {str(e)}"] * len(paths)
+
+    if not batch_size or batch_size >= len(paths):
+        return inference_on_preprocessed(preprocess_images(paths), tokenizer, model, question, max_new_tokens, paths)
+
+    # Chunk images with similar tile counts together: batch_chat pads every prompt to the
+    # longest in its batch, and each tile adds 256 image tokens
+    tile_counts = list(_preprocess_executor.map(_tile_count, paths))
+    order = sorted(range(len(paths)), key=lambda i: tile_counts[i])
+    chunks = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    chunk_paths = [[paths[i] for i in chunk] for chunk in chunks]
+    responses: List[str] = [""] * len(paths)
+    for chunk, sources, prepared in zip(chunks, chunk_paths, prefetch_iter(chunk_paths, preprocess_images)):
+        chunk_responses = inference_on_preprocessed(prepared, tokenizer, model, question, max_new_tokens, sources)
+        for i, response in zip(chunk, chunk_responses):
+            responses[i] = response
+    return responses
+
+def _model_device(model) -> Optional[torch.device]:
+    """Device the model runs on, or None when it can't be told and CUDA is unavailable"""
+    if hasattr(model, 'device'):
+        return torch.device(model.device)
+    if torch.cuda.is_available():
+        return torch.device('cuda')
+    return None
+
+def _concat_tiles(tiles: List[torch.Tensor], model) -> torch.Tensor:
+    """Concatenate per-image tiles, straight into pinned memory when the model is on CUDA
+
+    Writing the batch into a pinned buffer saves the extra host copy that
+    pin_memory() would otherwise make before the non-blocking upload.
+    """
+    device = _model_device(model)
+    if device is None or device.type != 'cuda':
+        return torch.cat(tiles)
+    if any(t.is_cuda for t in tiles):
+        # GPU-decoded tiles are already on the device; upload the others and join them there
+        return torch.cat([t.to(device, non_blocking=True) for t in tiles])
+    memory_format = torch.channels_last if tiles[0].is_contiguous(memory_format=torch.channels_last) else torch.contiguous_format
+    staged = torch.empty(
+        (sum(t.size(0) for t in tiles), *tiles[0].shape[1:]),
+        dtype=tiles[0].dtype, pin_memory=True, memory_format=memory_format
+    )
+    return torch.cat(tiles, out=staged)
+
+def _move_to_model_device(pixel_values: torch.Tensor, model) -> torch.Tensor:
+    """Move pixel values to the same device as the model
+
+    CUDA copies go through pinned memory with non_blocking=True so the
+    host-to-device transfer overlaps with the following Python work.
+    """
+    device = _model_device(model)
+    if device is None:
+        return pixel_values
+    if device.type == 'cuda' and not pixel_values.is_cuda:
+        return pixel_values.pin_memory().to(device, non_blocking=True)
+    return pixel_values.to(device)
+
+def inference_on_images(path: ImageSource, tokenizer, model, streamer=None,
+                        question: str = DEFAULT_QUESTION, max_new_tokens: int = MAX_NEW_TOKENS) -> str:
     """
     Perform image inference using InternVL3.5-2B model
+
+    The image can be a file path, an in-memory file object or a PIL image.
+    If a streamer (e.g. TextIteratorStreamer) is given, generated text is
+    pushed to it token by token; the full response is still returned.
+    question and max_new_tokens override the default prompt and answer length.
     """
+    if _is_vllm_engine(model):
+        return inference_on_images_batch([path], tokenizer, model, question=question, max_new_tokens=max_new_tokens)[0]
+
     try:
         logging.info(f"Starting inference for image: {path}")
         
         # Load and preprocess image for InternVL3.5
         logging.info("Loading and preprocessing image...")
-        pixel_values = load_image_for_internvl(path)
+        pixel_values = load_pixel_values(path)
         logging.info(f"Image preprocessed - shape: {pixel_values.shape}, dtype: {pixel_values.dtype}")
         
+        # Reuse cached vision features for unchanged files (VISION_CACHE=1)
+        features = _vision_features([path], [pixel_values], model)
+        
         # Move to the same device as the model
-        if hasattr(model, 'device'):
-            device = model.device
-            logging.info(f"Moving pixel values to model device: {device}")
-            pixel_values = pixel_values.to(device)
-        elif torch.cuda.is_available():
-            logging.info("Moving pixel values to CUDA")
-            pixel_values = pixel_values.cuda()
-        else:
-            logging.info("Using CPU for inference")
+        pixel_values = _move_to_model_device(pixel_values, model)
+        logging.info(f"Pixel values on device: {pixel_values.device}")
         
         # InternVL3.5 uses the model.chat() API with pixel values and <image> token
-        question = "<image>\nDescribe this image briefly."
         logging.info(f"Question for model: {question}")
         
         # Use the model.chat interface with preprocessed pixel values
         logging.info("Starting model.chat() inference...")
-        generation_config = dict(
-            max_new_tokens=128,  # Reduced for faster CPU inference
-            do_sample=False
-        )
+        generation_config = greedy_generation_config(max_new_tokens)
         logging.info(f"Generation config: {generation_config}")
+        if features is not None:
+            # generate() uses visual_features in place of running the vision encoder on pixel_values
+            generation_config["visual_features"] = features
+        if streamer is not None:
+            generation_config["streamer"] = streamer
         
         # Run inference without timeout constraints
-        response = model.chat(
-            tokenizer, 
-            pixel_values, 
-            question, 
-            generation_config=generation_config
-        )
+        with _generation_context(model):
+            response = model.chat(
+                tokenizer, 
+                pixel_values, 
+                question, 
+                generation_config=generation_config
+            )
         logging.info("Model chat completed successfully")
         
         logging.info(f"Inference completed successfully. Response length: {len(response) if response else 0}")
@@ -1,23 +1,81 @@
-from transformers import AutoProcessor, AutoModel, AutoTokenizer
+from transformers import AutoProcessor, AutoModel, AutoTokenizer, BitsAndBytesConfig, FineGrainedFP8Config
 import torch
 import logging
-from typing import List, Optional, Any
+import os
+import functools
+import gc
+import importlib.util
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Any, Union
 from dataclasses import dataclass, field
-from folders import inference_on_images, get_list_images, path_folder_env
+from PIL import Image
+from folders import (
+    inference_on_images, inference_on_images_batch, is_inference_error,
+    get_list_images, path_folder_env, _cached_load
+)
 
 # Configure logger for this module
 logger = logging.getLogger(__name__)
 
+# InternVL modules kept in bf16 when quantizing: the vision encoder, the vision-to-text
+# projector and the output head (which bitsandbytes skips by default when no list is given)
+UNQUANTIZED_MODULES = ["vision_model", "mlp1", "lm_head"]
 
-@dataclass
+
+class DescriptionCache:
+    """Thread-safe LRU cache mapping an image key to its generated description"""
+    
+    def __init__(self, maxsize: int = 10_000):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached description for key, or None on a miss"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+    
+    def put(self, key: str, description: str) -> None:
+        """Store a description, evicting the least recently used entry when full"""
+        with self._lock:
+            self._entries[key] = description
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        """Drop all cached descriptions"""
+        with self._lock:
+            self._entries.clear()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@dataclass(slots=True)
 class ImageProcessor:
     """Encapsulates model, processor and image processing logic using dataclass"""
     
     model_id: str = "OpenGVLab/InternVL3_5-1B"
+    backend: str = field(default_factory=lambda: os.getenv("VLM_BACKEND", "transformers"))
+    quantization: Optional[str] = field(default_factory=lambda: os.getenv("VLM_QUANTIZATION") or None)
+    torch_compile: bool = field(default_factory=lambda: os.getenv("TORCH_COMPILE", "0") == "1")
+    speculative_model: Optional[str] = field(default_factory=lambda: os.getenv("VLM_SPECULATIVE_MODEL") or None)
+    num_speculative_tokens: int = 5
+    batch_size: int = field(default_factory=lambda: int(os.getenv("MAX_BATCH_SIZE", "8")))
+    result_cache: DescriptionCache = field(
+        default_factory=lambda: DescriptionCache(int(os.getenv("RESULT_CACHE_SIZE", "10000"))), repr=False
+    )
     _model: Optional[Any] = field(default=None, init=False, repr=False)
     _processor: Optional[AutoProcessor] = field(default=None, init=False, repr=False)
     _tokenizer: Optional[AutoTokenizer] = field(default=None, init=False, repr=False)
     _is_loaded: bool = field(default=False, init=False, repr=False)
+    _load_lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
     
     def __post_init__(self):
         """Initialize model and processor after dataclass creation"""
@@ -68,38 +126,187 @@ class ImageProcessor:
         return self._is_loaded
     
     def _load_model_and_processor(self):
-        """Load the model and processor"""
+        """Load the model and processor
+
+        Guarded by a lock so threads racing on first use (API startup, the
+        inference thread, token streaming) load a single copy of the weights.
+        """
         if self._is_loaded:
             return
+        
+        with self._load_lock:
+            if self._is_loaded:
+                return
+            
+            if self.backend == "vllm":
+                self._load_vllm_engine()
+                return
+            
+            logger.info(f"Loading InternVL3.5 model: {self.model_id}")
+            
+            # Load tokenizer first for InternVL3.5
+            logger.info("Loading tokenizer...")
+            self._tokenizer = AutoTokenizer.from_pretrained(
+                self.model_id,
+                trust_remote_code=True,
+                use_fast=False
+            )
+            logger.info(f"Tokenizer loaded successfully. Vocab size: {len(self._tokenizer)}")
+            
+            # Load the model
+            logger.info("Loading model (this may take a few minutes for first download)...")
+            quantization_config = self._get_quantization_config()
+            if quantization_config is not None:
+                logger.info(f"Quantizing model weights to {self.quantization}")
+            # flash-attn often fails to build, so it is only used when it is already installed,
+            # and its FlashAttention-2 kernels need an Ampere or newer GPU
+            use_flash_attn = (
+                torch.cuda.is_available()
+                and torch.cuda.get_device_capability() >= (8, 0)
+                and importlib.util.find_spec("flash_attn") is not None
+            )
+            self._model = AutoModel.from_pretrained(
+                self.model_id,
+                torch_dtype=torch.bfloat16,
+                low_cpu_mem_usage=True,
+                use_flash_attn=use_flash_attn,
+                trust_remote_code=True,
+                device_map="auto",
+                quantization_config=quantization_config
+            ).eval()
+            attn_implementation = "flash_attention_2" if use_flash_attn else "sdpa"
+            if not use_flash_attn:
+                # InternVL's remote code falls back to eager attention in the language model;
+                # PyTorch's fused SDPA kernels avoid materialising the full attention matrix
+                try:
+                    self._model.language_model.set_attn_implementation("sdpa")
+                except (ValueError, AttributeError) as e:
+                    # Checkpoints whose language model doesn't support SDPA keep eager attention
+                    logger.warning(f"SDPA attention unavailable for this model: {e}")
+                    attn_implementation = "eager"
+            logger.info(f"Attention: {attn_implementation}")
+            # Pixel values arrive channels_last; match the patch-embedding conv weights to it
+            if torch.cuda.is_available():
+                self._model.vision_model.to(memory_format=torch.channels_last)
             
-        logger.info(f"Loading InternVL3.5 model: {self.model_id}")
+            logger.info(f"Model loaded successfully on device: {self._model.device if hasattr(self._model, 'device') else 'distributed'}")
+            logger.info(f"Model dtype: {next(self._model.parameters()).dtype}")
+            logger.info(f"Model memory footprint: {sum(p.numel() for p in self._model.parameters()) / 1e9:.2f}B parameters")
+            
+            if self.torch_compile:
+                self._compile_language_model()
+                self._compile_vision_model()
+            
+            if self.speculative_model:
+                logger.warning("VLM_SPECULATIVE_MODEL is only supported with VLM_BACKEND=vllm; ignoring it")
+            
+            # Note: We don't need AutoProcessor for InternVL3.5 as it uses direct model.chat() API
+            # Setting processor to None to avoid initialization issues
+            self._processor = None
+            
+            self._is_loaded = True
+    
+    def _compile_language_model(self):
+        """Compile the decoder forward and switch generation to a static KV cache
+
+        A static cache keeps decode shapes fixed so the compiled CUDA graphs
+        are replayed for every token instead of re-dispatching each op.
+        """
+        logger.info("Compiling language model with torch.compile (mode=reduce-overhead)...")
+        language_model = self._model.language_model
+        language_model.forward = torch.compile(language_model.forward, mode="reduce-overhead", dynamic=False)
+        language_model.generation_config.cache_implementation = "static"
+    
+    def _compile_vision_model(self):
+        """Compile the vision encoder with a dynamic tile dimension
+
+        Tile counts vary per image (1-6, more when images are batched), so
+        one dynamic-shape graph is reused instead of recompiling per count;
+        padding images to a fixed tile count would add image tokens to the prompt.
+        """
+        logger.info("Compiling vision model with torch.compile (dynamic tile count)...")
+        vision_model = self._model.vision_model
+        vision_model.forward = torch.compile(vision_model.forward, dynamic=True)
+    
+    def warmup(self):
+        """Run one dummy inference so the first request doesn't pay compile/autotune latency"""
+        logger.info("Warming up model with a dummy image...")
+        model, processor = self._ensure_models_loaded()
+        # One tile and two tiles: torch.compile specialises size 1, so the second
+        # image is what builds the dynamic vision graph reused for larger counts
+        sizes = [(448, 448), (896, 448)] if self.torch_compile else [(448, 448)]
+        for size in sizes:
+            inference_on_images(Image.new('RGB', size), self.tokenizer, model)
+        logger.info("Model warmup completed")
+    
+    def _get_quantization_config(self) -> Optional[Union[BitsAndBytesConfig, FineGrainedFP8Config]]:
+        """Build the bitsandbytes or FP8 config for the requested weight quantization
+
+        Only the language model is quantized: decode is bound by reading its
+        weights, while the vision encoder and projector are compute-bound on
+        batched tiles and stay in bf16. fp8 stores e4m3 weights with per-block
+        scales and runs the matmuls on FP8 tensor cores (Ada/Hopper and newer).
+        """
+        if not self.quantization or self.quantization == "bf16":
+            return None
+        if self.quantization == "int8":
+            return BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=UNQUANTIZED_MODULES)
+        if self.quantization == "nf4":
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+                bnb_4bit_quant_type="nf4",
+                # Quantize the per-block scales too, saving roughly another 0.4 bits per weight
+                bnb_4bit_use_double_quant=True,
+                llm_int8_skip_modules=UNQUANTIZED_MODULES
+            )
+        if self.quantization == "fp8":
+            if not torch.cuda.is_available() or torch.cuda.get_device_capability() < (8, 9):
+                raise ValueError("fp8 quantization needs a GPU with compute capability 8.9 or newer (Ada/Hopper)")
+            return FineGrainedFP8Config(modules_to_not_convert=UNQUANTIZED_MODULES)
+        raise ValueError(f"Unsupported quantization: {self.quantization} (expected 'bf16', 'int8', 'nf4' or 'fp8')")
+    
+    def _load_vllm_engine(self):
+        """Load the model into a vLLM engine (paged KV cache + continuous batching)"""
+        # vLLM has no "int8" method, and its bitsandbytes method only quantizes to 4 bits on load
+        if self.quantization == "int8":
+            raise ValueError(
+                "VLM_QUANTIZATION=int8 is not supported with VLM_BACKEND=vllm "
+                "(use bf16, nf4, fp8 or a vLLM quantization method such as awq or gptq)"
+            )
+        try:
+            from vllm import LLM
+        except ImportError as e:
+            raise RuntimeError("VLM_BACKEND=vllm requires the 'vllm' package to be installed") from e
+        
+        # vLLM runs NF4 through its bitsandbytes method; other values (e.g. "awq") are passed as-is
+        quantization = {"bf16": None, "nf4": "bitsandbytes"}.get(self.quantization, self.quantization)
         
-        # Load tokenizer first for InternVL3.5
-        logger.info("Loading tokenizer...")
-        self._tokenizer = AutoTokenizer.from_pretrained(
-            self.model_id,
+        # Draft proposals are verified in one target forward; "ngram" needs no draft model
+        speculative_config = None
+        if self.speculative_model:
+            method = {"method": "ngram", "prompt_lookup_max": 4} if self.speculative_model == "ngram" \
+                else {"model": self.speculative_model}
+            speculative_config = {**method, "num_speculative_tokens": self.num_speculative_tokens}
+            logger.info(f"Using speculative decoding: {speculative_config}")
+        
+        logger.info(f"Loading InternVL3.5 model with vLLM: {self.model_id}")
+        self._model = LLM(
+            model=self.model_id,
             trust_remote_code=True,
-            use_fast=False
+            max_model_len=8192,
+            max_num_seqs=64,
+            dtype="bfloat16",
+            enforce_eager=False,
+            limit_mm_per_prompt={"image": 1},
+            mm_processor_kwargs={"max_dynamic_patch": 6},
+            quantization=quantization,
+            speculative_config=speculative_config,
         )
-        logger.info(f"Tokenizer loaded successfully. Vocab size: {len(self._tokenizer)}")
-        
-        # Load the model
-        logger.info("Loading model (this may take a few minutes for first download)...")
-        self._model = AutoModel.from_pretrained(
-            self.model_id,
-            torch_dtype=torch.bfloat16,
-            low_cpu_mem_usage=True,
-            use_flash_attn=False,  # Disabled due to CUDA compilation issues
-            trust_remote_code=True,
-            device_map="auto"
-        ).eval()
-        
-        logger.info(f"Model loaded successfully on device: {self._model.device if hasattr(self._model, 'device') else 'distributed'}")
-        logger.info(f"Model dtype: {next(self._model.parameters()).dtype}")
-        logger.info(f"Model memory footprint: {sum(p.numel() for p in self._model.parameters()) / 1e9:.2f}B parameters")
+        self._tokenizer = self._model.get_tokenizer()
+        logger.info("vLLM engine loaded successfully")
         
-        # Note: We don't need AutoProcessor for InternVL3.5 as it uses direct model.chat() API
-        # Setting processor to None to avoid initialization issues
+        # vLLM handles image preprocessing internally
         self._processor = None
         
         self._is_loaded = True
@@ -132,52 +339,6 @@ class ImageProcessor:
             logger.error(error_msg)
             raise RuntimeError(error_msg) from e
     
-    def _process_single_image(self, image_path: str, model: Any, 
-                             image_index: int, total_images: int) -> bool:
-        """
-        Process a single image and return success status.
-        
-        Returns:
-            bool: True if processing was successful, False otherwise.
-        """
-        logger.info(f"Starting processing of image {image_index}/{total_images}: {image_path}")
-        
-        try:
-            import time
-            start_time = time.time()
-            
-            response = inference_on_images(image_path, self.tokenizer, model)
-            
-            end_time = time.time()
-            processing_time = end_time - start_time
-            
-            logger.info(f"Image {image_index}/{total_images} processed successfully in {processing_time:.2f}s")
-            logger.info(f"Response preview: {response[:100]}{'...' if len(response) > 100 else ''}")
-            print(f"Image {image_index}/{total_images}: {response}")
-            return True
-            
-        except FileNotFoundError:
-            logger.error(f"Image file not found: {image_path}")
-            return False
-            
-        except PermissionError:
-            logger.error(f"Permission denied accessing file: {image_path}")
-            return False
-            
-        except ValueError as e:
-            logger.error(f"Invalid image format or data for {image_path}: {e}")
-            return False
-            
-        except torch.cuda.OutOfMemoryError:
-            logger.error(f"GPU out of memory while processing {image_path}")
-            logger.warning("Attempting to clear GPU cache...")
-            self.clear_cache()
-            return False
-            
-        except Exception as e:
-            logger.error(f"Unexpected error processing {image_path}: {e}")
-            return False
-    
     def _log_batch_summary(self, successful_count: int, failed_count: int, total_processed: int) -> None:
         """Log and print the batch processing summary."""
         logger.info(f"Batch processing complete: {successful_count}/{total_processed} images processed successfully")
@@ -220,10 +381,23 @@ class ImageProcessor:
         total_to_process = min(num_images, len(image_paths))
         logger.info(f"Processing {total_to_process} images...")
         
+        # Images go through the model batch_size at a time: one vision-encoder
+        # forward and one batched generate per chunk instead of one per image
+        start_time = time.time()
+        responses = inference_on_images_batch(
+            image_paths[:total_to_process], self.tokenizer, model, batch_size=self.batch_size
+        )
+        processing_time = time.time() - start_time
+        logger.info(f"Processed {total_to_process} images in {processing_time:.2f}s")
+        
         successful_count = 0
-        for i in range(total_to_process):
-            if self._process_single_image(image_paths[i], model, i + 1, total_to_process):
-                successful_count += 1
+        for i, (image_path, response) in enumerate(zip(image_paths, responses), start=1):
+            if is_inference_error(response):
+                logger.error(f"Image {i}/{total_to_process} failed ({image_path}): {response}")
+                continue
+            logger.info(f"Response preview: {response[:100]}{'...' if len(response) > 100 else ''}")
+            print(f"Image {i}/{total_to_process}: {response}")
+            successful_count += 1
         
         # Handle results
         failed_count = total_to_process - successful_count
@@ -236,17 +410,32 @@ class ImageProcessor:
         """Reload the model with a new model_id if provided"""
         if new_model_id:
             self.model_id = new_model_id
-        self._is_loaded = False
-        self._model = None
-        self._processor = None
+        with self._load_lock:
+            self._is_loaded = False
+            # Free the old weights before loading new ones so both never sit in memory together
+            self._model = None
+            self._processor = None
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        # Descriptions from the previous model are no longer valid
+        self.result_cache.clear()
         self._load_model_and_processor()
     
     def clear_cache(self):
-        """Clear GPU cache to free memory"""
+        """Clear GPU cache and cached preprocessed images to free memory"""
+        _cached_load.cache_clear()
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
+@functools.lru_cache(maxsize=1)
+def get_image_processor() -> ImageProcessor:
+    """Return the process-wide ImageProcessor so the API and CLI share one copy of the weights"""
+    # TF32 matmuls speed up the fp32 parts of attention projections on Ampere+ GPUs
+    torch.backends.cuda.matmul.allow_tf32 = True
+    return ImageProcessor()
+
 if __name__ == "__main__":
-    image_processor: ImageProcessor = ImageProcessor()
+    image_processor: ImageProcessor = get_image_processor()
     folder_test: List[str] = get_list_images(str(path_folder_env), "jpg")
     image_processor.process_images_batch(folder_test)
\ No newline at end of file
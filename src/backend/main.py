@@ -1,16 +1,69 @@
-from functions import ImageProcessor, get_list_images, path_folder_env
+import os
+
+# Configure the CUDA caching allocator before torch is imported
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:256,garbage_collection_threshold:0.8")
+
+from functions import get_image_processor, get_list_images, path_folder_env
+import json
 import logging
+import urllib.error
+import urllib.request
+import torch
+
+# Set to a running API (run_api.py, e.g. http://127.0.0.1:8000) to reuse its warm model
+API_URL = os.getenv("IMAGE_API_URL", "")
+
+
+def process_with_running_api(folder_path: str, extension: str = "jpg") -> bool:
+    """Describe the folder through a running API instead of loading the model again
+
+    Returns False when no API is configured or the API fails, so the caller
+    can fall back to local inference.
+    """
+    if not API_URL:
+        return False
+    try:
+        urllib.request.urlopen(f"{API_URL}/health", timeout=1).close()
+    except (urllib.error.URLError, OSError):
+        return False
+
+    logging.info(f"Using the running API at {API_URL}")
+    request = urllib.request.Request(
+        f"{API_URL}/process/folder",
+        data=json.dumps({"folder_path": os.path.abspath(folder_path), "extension": extension}).encode(),
+        headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            result = json.load(response)
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        # HTTPError is a URLError and timeouts are OSErrors; e.g. a containerised API that
+        # can't see the folder answers 404
+        logging.warning(f"The running API could not process the folder, processing locally: {e}")
+        return False
+
+    results = result["results"]
+    for i, item in enumerate(results, start=1):
+        print(f"Image {i}/{len(results)}: {item.get('description') or item.get('error')}")
+    print(f"\nProcessing complete: {result.get('successful', 0)}/{len(results)} images processed successfully.")
+    return True
 
 
 def main():
-    # Initialize the image processor
-    processor = ImageProcessor()
+    if process_with_running_api(str(path_folder_env), "jpg"):
+        return
+    
+    # Get the shared image processor (model is loaded once per process)
+    processor = get_image_processor()
     
     # Get list of images
     folder_test = get_list_images(str(path_folder_env), "jpg")
     
-    # Process the images
-    processor.process_images_batch(folder_test)
+    # Process the images (inference only, no autograd bookkeeping)
+    with torch.inference_mode():
+        processor.process_images_batch(folder_test)
+    
+    # Release cached GPU memory once the run is over
+    processor.clear_cache()
 if __name__ == "__main__":
-    #qtorch.cuda.empty_cache()
     main()
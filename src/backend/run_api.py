@@ -8,6 +8,11 @@ import os
 import sys
 import logging
 
+# Configure the CUDA caching allocator before torch is imported (inherited by reload workers)
+# so the pool grows to its peak once and is reused across requests; idle cached blocks are
+# reclaimed once 80% of the GPU is in use, rather than an OOM forcing empty_cache()
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:256,garbage_collection_threshold:0.8")
+
 # Configure detailed logging
 logging.basicConfig(
     level=logging.INFO,
@@ -37,7 +42,10 @@ def main():
         "api.api:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,  # Auto-reload in development
+        # API_RELOAD=1 auto-reloads in development; every reload loads the model weights again
+        reload=os.getenv("API_RELOAD", "0") == "1",
+        # One process holds the one copy of the weights; scale out with one server per GPU
+        workers=1,
         log_level="info"
     )
 
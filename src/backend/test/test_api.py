@@ -4,7 +4,9 @@ Comprehensive API tests for the Image Processing API
 """
 
 import pytest
+import io
 import os
+import json
 import tempfile
 import shutil
 import urllib.parse
@@ -16,6 +18,8 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'api'))
 
 from api import app, image_processor
+from image_processor import DescriptionCache
+from folders import inference_on_preprocessed
 
 # Create a test client
 client = TestClient(app)
@@ -26,6 +30,7 @@ class MockImageProcessor:
     
     def __init__(self):
         self.tokenizer = MagicMock()
+        self.result_cache = DescriptionCache()
         self._models_loaded = False
         
     def _ensure_models_loaded(self):
@@ -76,6 +81,15 @@ def test_health_endpoint():
     assert response.json() == {"status": "healthy"}
 
 
+def test_cors_headers_for_allowed_origin():
+    """Test CORS headers come from the single CORS middleware, once per response"""
+    response = client.get("/health", headers={"Origin": "http://localhost:3000"})
+    assert response.headers["access-control-allow-origin"] == "http://localhost:3000"
+    
+    response = client.get("/health", headers={"Origin": "http://evil.example"})
+    assert "access-control-allow-origin" not in response.headers
+
+
 @pytest.fixture
 def test_image_file():
     """Create a temporary test image file"""
@@ -104,6 +118,28 @@ def test_process_single_image_success(test_image_file):
     assert data["description"] == "test description"
 
 
+def test_process_single_image_uses_result_cache(test_image_file):
+    """Test resubmitting the same image is served from the result cache"""
+    with patch('api.inference_on_images', return_value="test description") as mock_inference:
+        for _ in range(2):
+            with open(test_image_file, 'rb') as f:
+                response = client.post("/process/image", files={"file": ("test.jpg", f, "image/jpeg")})
+            assert response.status_code == 200
+            assert response.json()["description"] == "test description"
+    
+    assert mock_inference.call_count == 1
+
+
+def test_process_single_image_inference_error(test_image_file):
+    """Test an inference error message is returned as an error, not a successful description"""
+    with patch('api.inference_on_images', return_value="Error processing image: cannot identify image file"):
+        with open(test_image_file, 'rb') as f:
+            response = client.post("/process/image", files={"file": ("test.jpg", f, "image/jpeg")})
+    
+    assert response.status_code == 500
+    assert response.json()["detail"] == "Error processing image: cannot identify image file"
+
+
 def test_process_single_image_invalid_content_type():
     """Test single image processing with invalid content type"""
 
@@ -112,6 +148,47 @@ def test_process_single_image_no_file():
 
 def test_process_single_image_stream_success(test_image_file):
     """Test successful single image streaming processing"""
+    with patch('api.inference_on_images', return_value="test description") as mock_inference:
+        with open(test_image_file, 'rb') as f:
+            response = client.post("/process/image/stream", files={"file": ("test.jpg", f, "image/jpeg")})
+    
+    assert response.status_code == 200
+    assert "test description" in response.text
+    assert '"type":"complete"' in response.text
+    # The upload is decoded from memory rather than copied to a temporary file
+    assert isinstance(mock_inference.call_args[0][0], io.BytesIO)
+
+def test_process_single_image_stream_tokens(test_image_file):
+    """Test generated text is streamed as token events before the result"""
+    def fake_inference(path, tokenizer, model, streamer=None):
+        for token in ("a ", "test ", "description"):
+            streamer.on_finalized_text(token)
+        return "a test description"
+    
+    with patch('api.inference_on_images', side_effect=fake_inference):
+        with open(test_image_file, 'rb') as f:
+            response = client.post("/process/image/stream", files={"file": ("test.jpg", f, "image/jpeg")})
+    
+    assert response.status_code == 200
+    events = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert [event["text"] for event in events if event["type"] == "token"] == ["a ", "test ", "description"]
+    assert [event["type"] for event in events][-2:] == ["result", "complete"]
+
+
+def test_process_single_image_stream_inference_error(test_image_file):
+    """Test an inference error after partial tokens ends the stream with an error event"""
+    def fake_inference(path, tokenizer, model, streamer=None):
+        streamer.on_finalized_text("a ")
+        return "Error processing image: CUDA error"
+    
+    with patch('api.inference_on_images', side_effect=fake_inference):
+        with open(test_image_file, 'rb') as f:
+            response = client.post("/process/image/stream", files={"file": ("test.jpg", f, "image/jpeg")})
+    
+    events = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert [event["type"] for event in events][-2:] == ["token", "error"]
+    assert events[-1]["error"] == "Error processing image: CUDA error"
+
 
 def test_process_single_image_stream_invalid_content_type():
     """Test single image streaming with invalid content type"""
@@ -134,6 +211,134 @@ def test_folder_with_images():
 
 def test_process_folder_success(test_folder_with_images):
     """Test successful folder processing"""
+    with patch('api.inference_on_images_batch', side_effect=lambda paths, *args, **kwargs: ["test description"] * len(paths)) as mock_batch:
+        response = client.post("/process/folder", json={
+            "folder_path": test_folder_with_images,
+            "extension": "jpg",
+            "max_images": 2
+        })
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total_found"] == 3
+    assert data["processed"] == 2
+    assert data["successful"] == 2
+    assert all(result["description"] == "test description" for result in data["results"])
+    # All images are submitted in a single batched call
+    assert mock_batch.call_count == 1
+
+def test_process_folder_response_is_compressed(test_folder_with_images):
+    """Test large folder responses are gzip-compressed"""
+    long_description = "a detailed description " * 100
+    with patch('api.inference_on_images_batch', side_effect=lambda paths, *args, **kwargs: [long_description] * len(paths)):
+        response = client.post("/process/folder", json={
+            "folder_path": test_folder_with_images,
+            "extension": "jpg"
+        }, headers={"Accept-Encoding": "gzip"})
+    
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json()["results"][0]["description"] == long_description
+
+
+def test_batch_out_of_memory_is_split_and_retried():
+    """Test a batch that runs out of GPU memory is retried in halves until it fits"""
+    import torch
+    
+    class FakeModel:
+        device = torch.device("cpu")
+        batch_sizes = []
+        
+        def batch_chat(self, tokenizer, pixel_values, num_patches_list, **kwargs):
+            self.batch_sizes.append(len(num_patches_list))
+            if len(num_patches_list) > 2:
+                raise torch.cuda.OutOfMemoryError("CUDA out of memory")
+            return ["description"] * len(num_patches_list)
+    
+    model = FakeModel()
+    prepared = [torch.zeros(1, 3, 448, 448)] * 2 + ["Error processing image: unreadable"] + [torch.zeros(2, 3, 448, 448)] * 3
+    
+    responses = inference_on_preprocessed(prepared, MagicMock(), model)
+    
+    assert responses == ["description"] * 2 + ["Error processing image: unreadable"] + ["description"] * 3
+    assert model.batch_sizes == [5, 2, 3, 1, 2]
+
+
+def test_vision_features_are_cached_on_disk(tmp_path):
+    """Test a second run over unchanged files reuses the saved vision features"""
+    import torch
+    import folders
+    
+    paths = [create_test_image(str(tmp_path), f"image{i}.jpg") for i in range(2)]
+    prepared = [torch.zeros(1, 3, 448, 448), torch.zeros(2, 3, 448, 448)]
+    
+    class FakeModel:
+        device = torch.device("cpu")
+        name_or_path = "fake-model"
+        extracted_tiles = []
+        visual_features = []
+        
+        def extract_feature(self, pixel_values):
+            self.extracted_tiles.append(pixel_values.size(0))
+            return torch.ones(pixel_values.size(0), 256, 8)
+        
+        def batch_chat(self, tokenizer, pixel_values, num_patches_list, generation_config, **kwargs):
+            self.visual_features.append(generation_config.get("visual_features"))
+            return ["description"] * len(num_patches_list)
+    
+    model = FakeModel()
+    with patch.object(folders, "VISION_CACHE", True), patch.object(folders, "VISION_CACHE_DIR", str(tmp_path / "vision")):
+        for _ in range(2):
+            assert inference_on_preprocessed(prepared, MagicMock(), model, sources=paths) == ["description"] * 2
+        # A setting that changes the pixel values gets its own entries
+        with patch.object(folders, "VLM_MAX_EDGE", 512):
+            inference_on_preprocessed(prepared, MagicMock(), model, sources=paths)
+    
+    assert model.extracted_tiles == [3, 3]
+    assert all(features.shape == (3, 256, 8) for features in model.visual_features)
+
+
+def test_vision_cache_evicts_least_recently_used(tmp_path):
+    """Test the vision cache deletes its oldest entries once over the size cap"""
+    import folders
+    
+    for i in range(3):
+        path = create_test_image(str(tmp_path), f"{i}.pt", b"x" * 100)
+        os.utime(path, ns=(i, i))
+    
+    with patch.object(folders, "VISION_CACHE_DIR", str(tmp_path)):
+        folders._evict_vision_cache(250)
+    
+    assert sorted(os.listdir(tmp_path)) == ["1.pt", "2.pt"]
+
+
+def test_batch_groups_images_by_tile_count(tmp_path):
+    """Test chunks group images of similar tile counts and responses keep the input order"""
+    import torch
+    from PIL import Image
+    from folders import inference_on_images_batch
+    
+    # Wide images split into 3 tiles, square ones into 1
+    paths = []
+    for i, size in enumerate([(1344, 448), (448, 448), (1344, 448), (448, 448)]):
+        path = str(tmp_path / f"image{i}.jpg")
+        Image.new("RGB", size).save(path)
+        paths.append(path)
+    
+    class FakeModel:
+        device = torch.device("cpu")
+        batches = []
+        
+        def batch_chat(self, tokenizer, pixel_values, num_patches_list, **kwargs):
+            self.batches.append(num_patches_list)
+            return [f"{num_patches} tiles" for num_patches in num_patches_list]
+    
+    model = FakeModel()
+    responses = inference_on_images_batch(paths, MagicMock(), model, batch_size=2)
+    
+    assert model.batches == [[1, 1], [3, 3]]
+    assert responses == ["3 tiles", "1 tiles", "3 tiles", "1 tiles"]
+
 
 def test_process_folder_not_found():
     """Test folder processing with non-existent folder"""
@@ -143,6 +348,18 @@ def test_process_folder_not_a_directory():
 
 def test_process_folder_stream_success(test_folder_with_images):
     """Test successful folder streaming processing"""
+    with patch('api.inference_on_images_batch', side_effect=lambda paths, *args, **kwargs: ["test description"] * len(paths)):
+        response = client.get("/process/folder/stream", params={
+            "folder_path": test_folder_with_images,
+            "extension": "jpg"
+        })
+    
+    assert response.status_code == 200
+    events = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    types = [event["type"] for event in events]
+    # All images of a batch are announced before their results arrive
+    assert types == ["metadata", "start", "start", "start", "result", "result", "result", "complete"]
+    assert events[-1]["successful"] == 3
 
 def test_process_folder_stream_not_found():
     """Test folder streaming with non-existent folder"""
@@ -165,6 +382,17 @@ def test_preview_folder_images_success(test_folder_with_images):
     assert len(data["image_paths"]) == 3
 
 
+def test_preview_folder_images_multiple_extensions(test_folder_with_images):
+    """Test folder preview matches several extensions case-insensitively in one pass"""
+    create_test_image(test_folder_with_images, "upper.PNG")
+    response = client.post("/preview/folder", json={
+        "folder_path": test_folder_with_images,
+        "extension": "jpg,png"
+    })
+    
+    assert response.status_code == 200
+    assert response.json()["total_found"] == 4
+
 def test_preview_folder_images_not_found():
     """Test folder preview with non-existent folder"""
     response = client.post("/preview/folder", json={
@@ -197,6 +425,21 @@ def test_serve_image_success(test_image_file):
     assert response.status_code == 200
     # The content type should be image/jpeg for .jpg files
     assert response.headers["content-type"] == "image/jpeg"
+    # Images are cacheable by the browser
+    assert response.headers["cache-control"] == "public, max-age=86400"
+    assert "etag" in response.headers
+
+
+def test_serve_image_not_modified(test_image_file):
+    """Test revalidating an unchanged image returns 304 without a body"""
+    encoded_path = urllib.parse.quote(test_image_file)
+    etag = client.get(f"/image/{encoded_path}").headers["etag"]
+    
+    response = client.get(f"/image/{encoded_path}", headers={"If-None-Match": etag})
+    
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
 
 
 def test_serve_image_not_found():
@@ -208,6 +451,14 @@ def test_serve_image_not_found():
     assert "Image not found" in response.json()["detail"]
 
 
+def test_serve_image_file_as_directory_component(test_image_file):
+    """Test a path through a file (NotADirectoryError) is a plain 404 that doesn't leak the path"""
+    response = client.get("/image/" + urllib.parse.quote(os.path.join(test_image_file, "x.jpg")))
+    
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Image not found"
+
+
 def test_serve_image_not_a_file():
     """Test image serving with a directory path"""
     response = client.get("/image/" + urllib.parse.quote(os.path.dirname(__file__)))
@@ -224,5 +475,53 @@ def test_serve_image_not_an_image():
     assert "File is not an image" in response.json()["detail"]
 
 
+def test_serve_image_path_traversal():
+    """Test image serving rejects parent-directory segments"""
+    response = client.get("/image/" + urllib.parse.quote("/tmp/../etc/passwd.jpg", safe=""))
+    
+    assert response.status_code == 400
+    assert "Path traversal is not allowed" in response.json()["detail"]
+
+
+def test_vllm_backend_rejects_int8():
+    """Test int8 is refused up front with the vLLM backend, which has no such method"""
+    from image_processor import ImageProcessor
+    
+    processor = object.__new__(ImageProcessor)
+    processor.quantization = "int8"
+    with pytest.raises(ValueError, match="not supported with VLM_BACKEND=vllm"):
+        processor._load_vllm_engine()
+
+
+def test_cli_uses_running_api():
+    """Test the CLI reuses a running API and falls back to local processing when it fails"""
+    import urllib.error
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+    import main
+    
+    health = MagicMock()
+    folder = MagicMock()
+    folder.__enter__.return_value = io.BytesIO(json.dumps({"results": [{"description": "a cat"}], "successful": 1}).encode())
+    
+    with patch.object(main, "API_URL", "http://api.test"):
+        # No API answering the health check
+        with patch("urllib.request.urlopen", side_effect=urllib.error.URLError("refused")):
+            assert main.process_with_running_api("/photos") is False
+        
+        # The API answers but can't process the folder (e.g. not mounted in its container)
+        not_found = urllib.error.HTTPError("http://api.test/process/folder", 404, "Not Found", {}, None)
+        with patch("urllib.request.urlopen", side_effect=[health, not_found]):
+            assert main.process_with_running_api("/photos") is False
+        
+        with patch("urllib.request.urlopen", side_effect=[health, folder]) as mock_urlopen:
+            assert main.process_with_running_api("/photos") is True
+        assert json.loads(mock_urlopen.call_args[0][0].data)["folder_path"] == "/photos"
+    
+    # Without IMAGE_API_URL the CLI never contacts an API
+    with patch.object(main, "API_URL", ""), patch("urllib.request.urlopen") as mock_urlopen:
+        assert main.process_with_running_api("/photos") is False
+    mock_urlopen.assert_not_called()
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "-s"])
\ No newline at end of file
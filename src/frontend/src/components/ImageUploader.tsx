@@ -15,6 +15,7 @@ interface StreamingResult {
   description?: string
   message?: string
   error?: string
+  text?: string
 }
 
 const ImageUploader = () => {
@@ -119,12 +120,29 @@ const ImageUploader = () => {
         buffer = lines.pop() || ''
 
         for (const line of lines) {
-          if (line.trim()) {
+          // Events arrive as server-sent events: "data: {...}" followed by a blank line
+          const payload = line.startsWith('data:') ? line.slice('data:'.length).trim() : line.trim()
+          if (payload) {
             try {
-              const data = JSON.parse(line)
+              const data: StreamingResult = JSON.parse(payload)
+              
+              if (data.type === 'token') {
+                // Grow a single partial description instead of adding one item per token
+                setStreamingResults(prev => {
+                  const last = prev[prev.length - 1]
+                  if (last?.type === 'token') {
+                    return [...prev.slice(0, -1), { ...last, text: (last.text || '') + (data.text || '') }]
+                  }
+                  return [...prev, data]
+                })
+                continue
+              }
               console.log('Stream event:', data)
               
-              setStreamingResults(prev => [...prev, data])
+              // The final result (or an error) takes the place of the partial description
+              setStreamingResults(prev => data.type === 'result' || data.type === 'error'
+                ? [...prev.filter(item => item.type !== 'token'), data]
+                : [...prev, data])
               
               if (data.type === 'complete') {
                 setStreamingComplete(true)
@@ -254,6 +272,11 @@ const ImageUploader = () => {
                     <span>{item.message}</span>
                   </div>
                 )}
+                {item.type === 'token' && (
+                  <div className="streaming-result">
+                    <p className="description">{item.text}</p>
+                  </div>
+                )}
                 {item.type === 'result' && (
                   <div className="streaming-result">
                     <div className="result-meta">